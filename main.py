@@ -1,24 +1,93 @@
-import urllib.request
 import json
 import uuid
 import datetime
 import time
-from functools import lru_cache
+import random
+from functools import lru_cache, partial
 import re
 import os
+import sys
 import string
+import operator
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-import botocore
+import urllib3
+try:
+    import orjson
+except ImportError: # pragma: no cover
+    orjson = None
 
 IDENTITY_DOC_URL = 'http://169.254.169.254/latest/dynamic/instance-identity/document'
+IMDS_TOKEN_URL = 'http://169.254.169.254/latest/api/token'
+# seconds an IMDSv2 session token is valid for
+IMDS_TOKEN_TTL = 21600
+# seconds to wait for the metadata service, so hosts outside EC2 fail fast
+IMDS_TIMEOUT = 1
+# a single kept alive connection for the token and document requests
+IMDS_HTTP = urllib3.PoolManager(num_pools=1, maxsize=1, timeout=IMDS_TIMEOUT, retries=False)
 # cloudwatch ignores messages older than 14 days
 OLDEST_LOG_RETENTION = datetime.timedelta(days=14)
+# cloudwatch limits on a single PutLogEvents call
+MAX_BATCH_EVENTS = 10000
+MAX_BATCH_BYTES = 1048576
+# max bytes of events held back across all streams waiting for their batches to fill
+MAX_BUFFERED_BYTES = 8 * MAX_BATCH_BYTES
+# each event counts an extra 26 bytes towards the batch size
+EVENT_OVERHEAD_BYTES = 26
+# cloudwatch limit on a single event, including the overhead
+MAX_EVENT_BYTES = 262144
+# appended to values truncated to fit an event
+TRUNCATED_SUFFIX = '...[truncated {} chars]'
+# default number of threads uploading to cloudwatch at once
+UPLOAD_WORKERS = 16
+# max batches waiting/uploading per thread before reading the journal blocks
+PENDING_UPLOADS_PER_WORKER = 2
+# largest exponent used for backoff, however long throttling goes on
+MAX_BACKOFF_EXPONENT = 16
+# messages between recomputing the retention cutoff
+CUTOFF_REFRESH_MESSAGES = 1000
+# seconds between saving the journal cursor while uploading
+CURSOR_SAVE_INTERVAL = 5
+# cloudwatch logs client config, a connection is kept alive for each upload thread
+BOTO_CONFIG = dict(
+    # let botocore rate limit and retry throttled requests client side
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    tcp_keepalive=True,
+)
+# the instance of a templated unit, up to the unit type suffix
+UNIT_INSTANCE_REGEX = re.compile(r'@.*(?=\.)')
+# placeholder for fields missing from a message
+MISSING = object()
+# journald values that can be encoded in json
+SERIALISABLE_TYPES = (str, int, uuid.UUID, datetime.datetime)
+# exact types that are encoded as they are
+PLAIN_TYPES = frozenset((str, int))
+# exact types that need converting first
+VALUE_CONVERTERS = {datetime.datetime: datetime.datetime.timestamp, uuid.UUID: str}
+
+def get_imds_token():
+    ''' returns an IMDSv2 session token, or None if the metadata service only supports IMDSv1 '''
+    headers = {'X-aws-ec2-metadata-token-ttl-seconds': str(IMDS_TOKEN_TTL)}
+    try:
+        response = IMDS_HTTP.request('PUT', IMDS_TOKEN_URL, headers=headers)
+    except urllib3.exceptions.HTTPError:
+        # the PUT response can be dropped before it reaches a container (hop limit of 1)
+        return None
+    if response.status != 200:
+        return None
+    return response.data.decode('utf-8')
 
 @lru_cache(1)
 def get_instance_identity_document():
-    with urllib.request.urlopen(IDENTITY_DOC_URL) as src:
-        doc = json.loads(src.read().decode('utf-8'))
+    token = get_imds_token()
+    headers = ({'X-aws-ec2-metadata-token': token} if token else {})
+    response = IMDS_HTTP.request('GET', IDENTITY_DOC_URL, headers=headers)
+    if response.status != 200:
+        raise urllib3.exceptions.HTTPError('Failed to get instance identity document: HTTP {}'.format(response.status))
+    # json decodes utf-8 bytes itself
+    doc = json.loads(response.data)
     # remove null values and snake case keys
     return {k: v for k, v in doc.items() if v is not None}
 
@@ -27,11 +96,26 @@ def get_region():
         return os.environ['AWS_DEFAULT_REGION']
     return get_instance_identity_document()['region']
 
+def write_file_atomically(path, data):
+    ''' writes to a temporary file and renames it over path, so a crash leaves either the old or new contents '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # make the rename itself durable
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+# the set of unit names is small and repeats for every message
+@lru_cache(1024)
 def normalise_unit(unit):
-    if '@' in unit:
-        # remove templating in unit names e.g. sshd@127.0.0.1:12345.service -> sshd.service
-        unit = '.'.join(( unit.partition('@')[0], unit.rpartition('.')[2] ))
-    return unit
+    # remove templating in unit names e.g. sshd@127.0.0.1:12345.service -> sshd.service
+    return UNIT_INSTANCE_REGEX.sub('', unit, 1)
 
 class Formatter(string.Formatter):
     '''
@@ -47,65 +131,232 @@ class Formatter(string.Formatter):
     KeyError: 'a|b|c'
     >>> Format('{a|"ASD"}')
     'ASD'
+    >>> Formatter().compile('{a|b|c}')(dict(b=5))
+    '5'
     '''
 
+    # journald fields used by the custom $variables
+    SPECIAL_FIELDS = {
+        'unit': ('USER_UNIT', '_SYSTEMD_UNIT'),
+        'docker_container': ('CONTAINER_NAME', '_SYSTEMD_UNIT'),
+    }
+
     def get_value(self, key, args, kwargs):
         if isinstance(key, str):
-            for i in key.split('|'):
-                # test for string literal
-                if len(i) > 1 and (i[0] == '"' or i[0] == "'") and i[0] == i[-1]:
-                    return i[1:-1]
+            return self.lookup(self.key_getters(key), key, kwargs)
+        return super().get_value(key, args, kwargs)
+
+    @classmethod
+    @lru_cache(1024)
+    def key_getters(cls, key):
+        ''' the getters for a key, cached as the same few format strings are used over and over '''
+        return tuple(cls.compile_key(key))
+
+    @staticmethod
+    @lru_cache(1024)
+    def parse_key(key):
+        '''
+        splits the key a|b|c into its alternatives, up to the first string literal
+        returns a tuple of (literal, name) with name set to None for string literals
+        '''
+        alternatives = []
+        for i in key.split('|'):
+            if Formatter.is_literal(i):
+                alternatives.append((i[1:-1], None))
+                # nothing after a literal is ever used
+                break
+            alternatives.append((None, i))
+        return tuple(alternatives)
+
+    @staticmethod
+    def lookup(getters, key, kwargs):
+        ''' returns the value from the first getter that succeeds '''
+        for getter in getters:
+            try:
+                return getter(kwargs)
+            except KeyError:
+                pass
+        raise KeyError(key)
+
+    @classmethod
+    def compile_key(cls, key, bind=False):
+        '''
+        returns a getter for each alternative in the key a|b|c
+        each getter takes the kwargs and raises KeyError if its alternative is not found
+        if bind is set, $keys from the identity doc and environment are looked up now rather than on every call
+        '''
+        getters = []
+        for literal, i in cls.parse_key(key):
+            # test for string literal
+            if i is None:
+                getters.append(lambda kwargs, value=literal: value)
+                break
+
+            # test for special key
+            if i.startswith('$'):
+                if bind:
+                    getters.extend(cls.bind_special_value(i[1:]))
+                else:
+                    getters.append(partial(cls.get_special_value, i[1:]))
+
+            # default
+            getters.append(operator.itemgetter(i))
+        return getters
+
+    @classmethod
+    def get_special_value(cls, key, kwargs):
+        ''' looks up a $key '''
+        # instance identity doc variables
+        doc = get_instance_identity_document()
+        if key in doc:
+            return doc[key]
+
+        # custom journald variables
+        try:
+            return cls.get_journald_value(key, kwargs)
+        except KeyError:
+            pass
+
+        # environment variables
+        return os.environ[key]
+
+    @classmethod
+    def bind_special_value(cls, key):
+        ''' returns the getters for a $key, same as get_special_value() but with the identity doc and environment fixed now '''
+        doc = get_instance_identity_document()
+        if key in doc:
+            return [lambda kwargs, value=doc[key]: value]
+
+        getters = []
+        if key in cls.SPECIAL_FIELDS:
+            getters.append(partial(cls.get_journald_value, key))
+        if key in os.environ:
+            getters.append(lambda kwargs, value=os.environ[key]: value)
+        return getters
+
+    @staticmethod
+    def get_journald_value(key, kwargs):
+        ''' looks up the custom journald variables '''
+        if key == 'unit':
+            if 'USER_UNIT' in kwargs:
+                return normalise_unit(kwargs['USER_UNIT'])
+            if '_SYSTEMD_UNIT' in kwargs:
+                return normalise_unit(kwargs['_SYSTEMD_UNIT'])
+        if key == 'docker_container':
+            if 'CONTAINER_NAME' in kwargs and kwargs.get('_SYSTEMD_UNIT') == 'docker.service':
+                return kwargs['CONTAINER_NAME'] + '.container'
+        raise KeyError(key)
+
+    @staticmethod
+    def is_literal(key):
+        return len(key) > 1 and (key[0] == '"' or key[0] == "'") and key[0] == key[-1]
+
+    @staticmethod
+    def is_simple_field(field_name, format_spec):
+        ''' false for positional, attribute/index or nested fields '''
+        return bool(field_name) and not field_name.isdigit() and '.' not in field_name and '[' not in field_name and '{' not in format_spec
 
-                # test for special key
+    def fields(self, format_string):
+        '''
+        returns the set of kwargs that formatting could read
+        or None if this cannot be worked out
+        '''
+        fields = set()
+        for literal, field_name, format_spec, conversion in self.parse(format_string):
+            if field_name is None:
+                continue
+            if not self.is_simple_field(field_name, format_spec):
+                return None
+            for literal, i in self.parse_key(field_name):
+                if i is None:
+                    break
                 if i.startswith('$'):
-                    k = i[1:]
-                    # instance identity doc variables
-                    doc = get_instance_identity_document()
-                    if k in doc:
-                        return doc[k]
-
-                    # custom journald variables
-                    if k == 'unit':
-                        if 'USER_UNIT' in kwargs:
-                            return normalise_unit(kwargs['USER_UNIT'])
-                        if '_SYSTEMD_UNIT' in kwargs:
-                            return normalise_unit(kwargs['_SYSTEMD_UNIT'])
-                    if k == 'docker_container':
-                        if 'CONTAINER_NAME' in kwargs and kwargs.get('_SYSTEMD_UNIT') == 'docker.service':
-                            return kwargs['CONTAINER_NAME'] + '.container'
-
-                    # environment variables
-                    if k in os.environ:
-                        return os.environ[k]
-
-                # default
-                if i in kwargs:
-                    return kwargs[i]
+                    fields.update(self.SPECIAL_FIELDS.get(i[1:], ()))
+                fields.add(i)
+        return fields
 
-        return super().get_value(key, args, kwargs)
+    def compile(self, format_string):
+        '''
+        parses the format string once
+        returns a function that formats a dict of kwargs (e.g. a journald message)
+        $keys from the identity doc and environment are looked up once here
+        '''
+        fields = []
+        for literal, field_name, format_spec, conversion in self.parse(format_string):
+            if field_name is None:
+                fields.append((literal, None, None, None, None))
+            elif not self.is_simple_field(field_name, format_spec):
+                # leave these to the full formatter
+                return lambda kwargs: self.vformat(format_string, (), kwargs)
+            else:
+                fields.append((literal, field_name, self.compile_key(field_name, bind=True), conversion, format_spec))
+
+        def format_kwargs(kwargs):
+            result = []
+            for literal, key, getters, conversion, format_spec in fields:
+                result.append(literal)
+                if getters is not None:
+                    value = self.convert_field(self.lookup(getters, key, kwargs), conversion)
+                    result.append(self.format_field(value, format_spec))
+            return ''.join(result)
+        return format_kwargs
 
 Format = Formatter().format
 
-class JournalMsgEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime.datetime):
-            return obj.timestamp()
-        if isinstance(obj, uuid.UUID):
-            return str(obj)
-        return super().default(obj)
-
 class CloudWatchClient:
-    def __init__(self, cursor_path, log_group_format, log_stream_format):
-        self.client = boto3.client('logs', region_name=get_region())
+    def __init__(self, cursor_path, log_group_format, log_stream_format, matches=(), workers=UPLOAD_WORKERS, known_path=None):
+        # boto3 is slow to import, so only import it when it is needed
+        import boto3
+        import botocore.config
+        config = botocore.config.Config(max_pool_connections=workers, **BOTO_CONFIG)
+        self.client = boto3.client('logs', region_name=get_region(), config=config)
+        # uploads to different streams (and the same stream) run in parallel
+        self.executor = ThreadPoolExecutor(workers)
+        self.max_pending_uploads = workers * PENDING_UPLOADS_PER_WORKER
         self.cursor_path = cursor_path
+        # journal matches (FIELD=value), so journald skips other entries itself
+        self.matches = matches
+        # cursor of finished uploads that has not been saved yet
+        self.pending_cursor = None
+        self.saved_cursor = None
+        self.cursor_saved_at = float('-inf')
+        # groups and streams already created, only the groups are remembered across restarts in this file
+        self.known_path = known_path
+        self.known = self.load_known()
+        self.known_lock = threading.Lock()
         self.log_group_format = log_group_format
         self.log_stream_format = log_stream_format
+        self.group_formatter = Formatter().compile(log_group_format)
+        self.stream_formatter = Formatter().compile(log_stream_format)
+        # the only message fields that affect the group and stream names
+        group_fields = Formatter().fields(log_group_format)
+        stream_fields = Formatter().fields(log_stream_format)
+        if group_fields is None or stream_fields is None:
+            self.format_fields = None
+        else:
+            self.format_fields = tuple(sorted(group_fields | stream_fields))
 
     def get_group_stream(self, msg):
+        ''' returns the group and stream names for this msg, cached on the fields the formats use '''
+        if self.format_fields is not None:
+            values = tuple(msg.get(k, MISSING) for k in self.format_fields)
+            try:
+                return self.cached_group_stream(values)
+            except TypeError:
+                # unhashable field values
+                pass
+        return self.make_group_stream(msg)
+
+    @lru_cache(1024)
+    def cached_group_stream(self, values):
+        msg = {k: v for k, v in zip(self.format_fields, values) if v is not MISSING}
+        return self.make_group_stream(msg)
+
+    def make_group_stream(self, msg):
         ''' returns the group and stream names for this msg '''
-        group = Format(self.log_group_format, **msg)
+        group = self.group_formatter(msg)
         group = self.log_group_client(group)
-        stream = Format(self.log_stream_format, **msg)
+        stream = self.stream_formatter(msg)
         return (group, stream)
 
     @lru_cache(None)
@@ -113,43 +364,87 @@ class CloudWatchClient:
         ''' get or create a log group client '''
         return LogGroupClient(name, self)
 
-    def put_log_messages(self, log_group, log_stream, seq_token, messages):
-        ''' log the message to cloudwatch, then save the cursor '''
-        kwargs = (dict(sequenceToken=seq_token) if seq_token else {})
-        log_events = list(map(self.make_message, messages))
-
-        result = self.client.put_log_events(
+    def put_log_messages(self, log_group, log_stream, log_events):
+        ''' log the events to cloudwatch, sequence tokens are no longer needed '''
+        return self.client.put_log_events(
             logGroupName=log_group,
             logStreamName=log_stream,
             logEvents=log_events,
-            **kwargs
         )
-        # save last cursor
-        self.save_cursor(messages[-1]['__CURSOR'])
-        return result
 
     @staticmethod
-    def make_message(message):
-        ''' prepare a message to send to cloudwatch '''
+    def make_sized_message(message):
+        '''
+        prepare a message to send to cloudwatch
+        returns the log event and the size of its message in utf-8 bytes
+        '''
         timestamp = int(message['__REALTIME_TIMESTAMP'].timestamp() * 1000)
-        # remove unserialisable values
-        message = {k: v for k, v in message.items() if isinstance(v, (str, int, uuid.UUID, datetime.datetime))}
-        # encode entire message in json
-        message = json.dumps(message, cls=JournalMsgEncoder)
-        return dict(timestamp=timestamp, message=message)
+        # convert values up front so the encoder never needs a fallback
+        # and remove unserialisable values
+        values = {}
+        for k, v in message.items():
+            # dispatch on the exact type, this is much cheaper than isinstance for every value
+            t = type(v)
+            if t in PLAIN_TYPES:
+                values[k] = v
+            elif t in VALUE_CONVERTERS:
+                values[k] = VALUE_CONVERTERS[t](v)
+            elif isinstance(v, SERIALISABLE_TYPES):
+                # subclasses, which journald rarely gives us
+                if isinstance(v, datetime.datetime):
+                    v = v.timestamp()
+                elif isinstance(v, uuid.UUID):
+                    v = str(v)
+                values[k] = v
+        message, size = CloudWatchClient.encode_values(values)
+        if size > MAX_EVENT_BYTES - EVENT_OVERHEAD_BYTES:
+            message, size = CloudWatchClient.truncate_values(values, size)
+        return dict(timestamp=timestamp, message=message), size
+
+    @staticmethod
+    def encode_values(values):
+        ''' encode entire message in json, returns it and its size without encoding it again '''
+        if orjson:
+            data = orjson.dumps(values)
+            return data.decode('utf-8'), len(data)
+        # ascii only, so each character is one byte
+        message = json.dumps(values, ensure_ascii=True)
+        return message, len(message)
 
     @staticmethod
-    def retain_message(message, retention=OLDEST_LOG_RETENTION):
-        ''' cloudwatch ignores messages older than 14 days '''
-        if not message:
-            # keep message breakers
-            return True
-        return (datetime.datetime.now() - message['__REALTIME_TIMESTAMP']) < retention
+    def truncate_values(values, size):
+        '''
+        truncates the longest strings in values until the message fits in a single event
+        otherwise cloudwatch rejects the entire batch
+        '''
+        print('Truncating log event of', size, 'bytes', file=sys.stderr)
+        limit = MAX_EVENT_BYTES - EVENT_OVERHEAD_BYTES
+        encoded_size = lambda v: CloudWatchClient.encode_values(v)[1]
+        truncated = dict(values)
+        keys = [k for k, v in values.items() if isinstance(v, str) and v]
+        while size > limit and keys:
+            key = max(keys, key=lambda k: len(values[k]))
+            keys.remove(key)
+            value = values[key]
+            cut = lambda n: value[:n] + TRUNCATED_SUFFIX.format(len(value) - n)
+            # bytes left for this field once the rest of the message is accounted for
+            target = encoded_size(value) - (size - limit)
+            # characters encode to anywhere from 1 to 6 bytes (\uXXXX escapes),
+            # so bisect for the longest prefix that fits rather than cutting by the byte excess
+            lo, hi = 0, len(value) - 1
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if encoded_size(cut(mid)) <= target:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            truncated[key] = cut(lo)
+            message, size = CloudWatchClient.encode_values(truncated)
+        return message, size
 
     def save_cursor(self, cursor):
-        ''' saves the journal cursor to file '''
-        with open(self.cursor_path, 'w') as f:
-            f.write(cursor)
+        ''' saves the journal cursor to file, atomically so a crash cannot leave it truncated '''
+        write_file_atomically(self.cursor_path, cursor)
 
     def load_cursor(self):
         ''' loads the journal cursor from file, returns None if file not found '''
@@ -159,58 +454,191 @@ class CloudWatchClient:
         except FileNotFoundError:
             return
 
-    def group_messages(self, messages, maxlen=10, timespan=datetime.timedelta(hours=23)):
+    def load_known(self):
+        ''' loads the known groups from file, returns {group: set()} as streams are not saved '''
+        if not self.known_path:
+            return {}
+        try:
+            with open(self.known_path, 'r') as f:
+                known = json.load(f)
+            # older files map each group to its streams, only the groups are used
+            return {group: set() for group in known}
+        except (FileNotFoundError, ValueError, TypeError):
+            return {}
+
+    def save_known(self):
+        ''' saves the known groups to file '''
+        if self.known_path:
+            write_file_atomically(self.known_path, json.dumps(sorted(self.known)))
+
+    def remember(self, log_group, log_stream=None):
+        '''
+        remembers that a group (and stream) exists, returns the set of known streams in the group
+        streams are only kept in memory, there can be one for every container and a missing stream is recreated anyway
         '''
+        with self.known_lock:
+            streams = self.known.get(log_group)
+            if streams is None:
+                streams = self.known[log_group] = set()
+                self.save_known()
+            if log_stream is not None:
+                streams.add(log_stream)
+        return streams
+
+    def group_messages(self, messages, retention=None, maxlen=MAX_BATCH_EVENTS, maxbytes=MAX_BATCH_BYTES, timespan=datetime.timedelta(hours=23), maxbuffered=MAX_BUFFERED_BYTES):
+        '''
+        drops messages older than the retention (cloudwatch ignores messages older than 14 days)
         group messages:
-            - based on group, stream
+            - based on group, stream, each has its own batch as messages from different units interleave
             - in 23 hour segments (cloudwatch rejects logs spanning > 24 hours)
-            - in groups of 10 to avoid upload limits
+            - in batches of up to 10000 events / 1MB to avoid upload limits
+        batches are held until they are full, the journal is idle or more than maxbuffered bytes are held in total
+        yields the group/stream, the log events and the cursor up to which every message has been yielded
+        once everything has been flushed when the journal is idle, yields None for the group/stream and the events
         '''
-        key = None
-        start_date = datetime.datetime.fromtimestamp(0)
-        batch = []
+        # compare the integer millisecond timestamps of the events
+        timespan = timespan // datetime.timedelta(milliseconds=1)
+        # open batches by group/stream, oldest first
+        batches = collections.OrderedDict()
+        buffered = 0
+        # cursor of the last message read
+        cursor = None
+        # the cutoff is only recomputed every so often, not for every message
+        cutoff = None
+        count = 0
+
+        def flush(key):
+            nonlocal buffered
+            batch = batches.pop(key)
+            buffered -= batch.size
+            if batches:
+                # messages from the oldest open batch onwards have not been uploaded yet
+                safe_cursor = next(iter(batches.values())).prev_cursor
+            else:
+                safe_cursor = cursor
+            return key, batch.events, safe_cursor
+
         for msg in messages:
-            newkey = msg and self.get_group_stream(msg)
-            ts = msg.get('__REALTIME_TIMESTAMP')
-            if not msg or newkey != key or len(batch) >= maxlen or (ts - start_date) > timespan:
-                if batch:
-                    yield key, batch
-                batch = []
-                start_date = ts
-                key = newkey
-            if msg:
-                batch.append(msg)
-        if batch:
-            yield key, batch
+            if not msg:
+                # message breaker, the journal is idle so flush everything
+                while batches:
+                    yield flush(next(iter(batches)))
+                # even if there was nothing to flush, the caller gets a chance to save the cursor
+                yield None, None, cursor
+                # the journal may have been idle for a while, recompute the cutoff
+                count = 0
+                continue
+
+            if retention is not None:
+                if count % CUTOFF_REFRESH_MESSAGES == 0:
+                    cutoff = datetime.datetime.now() - retention
+                count += 1
+                if msg['__REALTIME_TIMESTAMP'] <= cutoff:
+                    cursor = msg['__CURSOR']
+                    continue
+
+            key = self.get_group_stream(msg)
+            # serialise once here, the size counts towards the batch limit
+            event, size = self.make_sized_message(msg)
+            size += EVENT_OVERHEAD_BYTES
+            ts = event['timestamp']
+            batch = batches.get(key)
+            if batch is not None and (len(batch.events) >= maxlen or batch.size + size > maxbytes or (ts - batch.start_ts) > timespan):
+                yield flush(key)
+                batch = None
+            if batch is None:
+                batch = batches[key] = Batch(ts, cursor)
+            batch.events.append(event)
+            batch.size += size
+            buffered += size
+            cursor = msg['__CURSOR']
+
+            # keep memory bounded when there are lots of streams
+            while buffered > maxbuffered:
+                yield flush(next(iter(batches)))
+
+        while batches:
+            yield flush(next(iter(batches)))
+
+    def save_uploaded_cursor(self, uploads, wait=False, cursor=None):
+        '''
+        uploads is a queue of (future, cursor) in journal order
+        saves the cursor of the latest upload where it and all the uploads before it have finished
+        the cursor is saved at most every CURSOR_SAVE_INTERVAL seconds
+        if wait is set, waits for all uploads to finish,
+        cursor is then saved instead as every message up to it has been uploaded
+        otherwise only waits while there are more than max_pending_uploads
+        '''
+        while uploads and (wait or uploads[0][0].done() or len(uploads) > self.max_pending_uploads):
+            future, uploaded_cursor = uploads.popleft()
+            # raises if the upload failed
+            future.result()
+            if uploaded_cursor is not None:
+                self.pending_cursor = uploaded_cursor
+        # the journal wakes up every so often while it is quiet, don't save the same cursor again
+        if wait and cursor is not None and cursor != self.saved_cursor:
+            self.pending_cursor = cursor
+
+        now = time.monotonic()
+        if self.pending_cursor is not None and now - self.cursor_saved_at >= CURSOR_SAVE_INTERVAL:
+            self.save_cursor(self.pending_cursor)
+            self.saved_cursor = self.pending_cursor
+            self.pending_cursor = None
+            self.cursor_saved_at = now
 
     def upload_journal_logs(self, log_path):
         import systemd.journal
         cursor = self.load_cursor()
         with systemd.journal.Reader(path=log_path) as reader:
-            reader = JournaldClient(reader, cursor)
-            reader = filter(self.retain_message, reader)
-            for (group, stream), messages in self.group_messages(reader):
-                group.log_messages(stream, messages)
+            journal = JournaldClient(reader, cursor, self.matches)
+            uploads = collections.deque()
+            for key, log_events, cursor in self.group_messages(journal, OLDEST_LOG_RETENTION):
+                if key is None:
+                    # the journal is about to block waiting for new messages and every batch has been submitted,
+                    # so finish the uploads so the cursor is up to date
+                    self.save_uploaded_cursor(uploads, wait=True, cursor=cursor)
+                    continue
+                group, stream = key
+                uploads.append((self.executor.submit(group.log_messages, stream, log_events), cursor))
+                self.save_uploaded_cursor(uploads)
+
+class Batch:
+    ''' log events for a single group/stream waiting to be uploaded '''
+    def __init__(self, start_ts, prev_cursor):
+        self.events = []
+        self.size = 0
+        self.start_ts = start_ts
+        # cursor of the message read before this batch started
+        self.prev_cursor = prev_cursor
 
 class JournaldClient:
-    def __init__(self, reader, cursor):
+    def __init__(self, reader, cursor, matches=()):
         self.reader = reader
         self.cursor = cursor
         self.wait = False
 
+        if matches:
+            # journal matches (FIELD=value), so journald skips other entries itself
+            self.reader.add_match(*matches)
+
+        cutoff = datetime.datetime.now() - OLDEST_LOG_RETENTION
         if self.cursor:
             self.reader.seek_cursor(self.cursor)
             # skip first log (which matches cursor)
-            self.reader.get_next()
+            msg = self.reader.get_next()
+            if msg and msg['__REALTIME_TIMESTAMP'] < cutoff:
+                # cursor is older than cloudwatch accepts, seek past the old logs
+                self.reader.seek_realtime(cutoff)
         else:
             # no cursor, start from 14 days ago
-            self.reader.seek_realtime(datetime.datetime.now() - OLDEST_LOG_RETENTION)
+            self.reader.seek_realtime(cutoff)
 
     def __iter__(self):
         return self
     def __next__(self):
         if self.wait:
-            self.reader.wait()
+            # wake up every so often while the journal is quiet, so a pending cursor is still saved
+            self.reader.wait(CURSOR_SAVE_INTERVAL)
         msg = self.reader.get_next()
         self.wait = not msg
         return msg
@@ -219,17 +647,23 @@ class LogGroupClient:
     ALREADY_EXISTS = 'ResourceAlreadyExistsException'
     THROTTLED = 'ThrottlingException'
     OPERATION_ABORTED = 'OperationAbortedException'
-    INVALID_TOKEN = 'InvalidSequenceTokenException'
-    NEXT_TOKEN_REGEX = re.compile('sequenceToken(\sis)?: (\S+)')
+    NOT_FOUND = 'ResourceNotFoundException'
 
     def __init__(self, log_group, parent):
         self.log_group = log_group
         self.parent = parent
-        self.tokens = {}
-        self.create_log_group()
+        # uploads run in multiple threads
+        self.lock = threading.Lock()
+        # streams that are known to exist, only create the group if it is not known already
+        streams = parent.known.get(log_group)
+        if streams is None:
+            self.create_log_group()
+            streams = parent.remember(log_group)
+        self.streams = streams
 
     def create_log_group(self):
         ''' create a log group, ignoring if it exists '''
+        import botocore.exceptions
         try:
             self.parent.client.create_log_group(logGroupName=self.log_group)
         except botocore.exceptions.ClientError as e:
@@ -238,63 +672,61 @@ class LogGroupClient:
 
     def create_log_stream(self, log_stream):
         ''' create a log stream, ignoring if it exists '''
+        import botocore.exceptions
         try:
             self.parent.client.create_log_stream(logGroupName=self.log_group, logStreamName=log_stream)
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] != self.ALREADY_EXISTS:
                 raise
 
-    def log_messages(self, log_stream, messages):
-        ''' log the messages '''
-        if not messages:
+    def ensure_log_stream(self, log_stream):
+        ''' create the log stream the first time it is used '''
+        if log_stream in self.streams:
+            return
+        with self.lock:
+            if log_stream not in self.streams:
+                self.create_log_stream(log_stream)
+                self.parent.remember(self.log_group, log_stream)
+
+    def log_messages(self, log_stream, log_events):
+        ''' log the events '''
+        if not log_events:
             return
 
+        import botocore.exceptions
+        self.ensure_log_stream(log_stream)
+        attempt = 0
+        recreated = False
         while True:
             try:
-                seq_token = self.get_seq_token(log_stream)
-                result = self.parent.put_log_messages(self.log_group, log_stream, seq_token, messages)
+                self.parent.put_log_messages(self.log_group, log_stream, log_events)
             except botocore.exceptions.ClientError as e:
                 code = e.response['Error']['Code']
                 if code == self.THROTTLED:
-                    # throttled, wait a bit and retry
-                    time.sleep(1)
+                    # throttled, back off and retry
+                    time.sleep(self.backoff(attempt))
+                    attempt += 1
                 elif code == self.OPERATION_ABORTED:
                     # aborted, retry
                     pass
-                elif code == self.INVALID_TOKEN:
-                    # invalid token, use the given token (if any)
-                    match = self.NEXT_TOKEN_REGEX.search(e.response['Error']['Message'])
-                    if match:
-                        self.tokens[log_stream] = (None if match.group(2) == 'null' else match.group(2))
-                    else:
-                        self.tokens.pop(log_stream)
+                elif code == self.NOT_FOUND and not recreated:
+                    # deleted since it was remembered, create it again and retry
+                    recreated = True
+                    self.create_log_group()
+                    self.create_log_stream(log_stream)
                 else:
                     # other error
                     raise
             else:
                 # no error, finish
                 break
-        self.tokens[log_stream] = result['nextSequenceToken']
-
-    def get_seq_token(self, log_stream):
-        ''' get the sequence token for the stream '''
 
-        try:
-            return self.tokens[log_stream]
-        except KeyError:
-            pass
-        token = self.tokens[log_stream] = self.get_new_seq_token(log_stream)
-        return token
-
-    def get_new_seq_token(self, log_stream):
-        streams = self.parent.client.describe_log_streams(logGroupName=self.log_group, logStreamNamePrefix=log_stream, limit=1)
-        if streams['logStreams']:
-            stream = streams['logStreams'][0]
-            if stream['logStreamName'] == log_stream:
-                # found the stream
-                return stream.get('uploadSequenceToken')
-        # no stream, create it
-        self.create_log_stream(log_stream)
+    @staticmethod
+    def backoff(attempt, base=0.1, cap=30):
+        ''' exponential backoff with full jitter, so throttled uploads don't all retry at once '''
+        # the cap is reached long before this, it only stops the float overflowing
+        attempt = min(attempt, MAX_BACKOFF_EXPONENT)
+        return min(cap, base * 2 ** attempt) * random.random()
 
 if __name__ == '__main__': # pragma: no cover
     import argparse
@@ -309,8 +741,12 @@ if __name__ == '__main__': # pragma: no cover
                        help='Python format string for log group names')
     parser.add_argument('-s', '--log-stream-format', required=True,
                        help='Python format string for log stream names')
+    parser.add_argument('-m', '--match', action='append', default=[],
+                        help='Only upload journal entries matching FIELD=VALUE (can be repeated)')
+    parser.add_argument('-w', '--workers', type=int, default=UPLOAD_WORKERS,
+                        help='Number of threads uploading to CloudWatch at once (default: %(default)s)')
     args = parser.parse_args()
 
-    client = CloudWatchClient(args.cursor, args.log_group_format, args.log_stream_format)
+    client = CloudWatchClient(args.cursor, args.log_group_format, args.log_stream_format, args.match, args.workers, args.cursor + '.known')
     while True:
         client.upload_journal_logs(args.logs)
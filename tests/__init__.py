@@ -0,0 +1,5 @@
+import os
+
+# the tests never talk to aws, but boto3 needs a region to create clients
+# set it once here rather than in every test case
+os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
@@ -1,15 +1,27 @@
 from unittest import TestCase
-from unittest.mock import patch, sentinel, call, create_autospec, Mock, MagicMock, DEFAULT
+from unittest.mock import patch, sentinel, call, create_autospec, Mock, MagicMock, DEFAULT, ANY
 import tempfile
 import os
 import uuid
 import json
 import sys
+import itertools
+import collections
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from moto import mock_cloudwatch
 import systemd.journal
+import main
 
-from main import get_region, CloudWatchClient, JournalMsgEncoder, LogGroupClient, Format, OLDEST_LOG_RETENTION
+from main import get_region, CloudWatchClient, LogGroupClient, Format, OLDEST_LOG_RETENTION, EVENT_OVERHEAD_BYTES, CURSOR_SAVE_INTERVAL, BOTO_CONFIG, UPLOAD_WORKERS, MAX_EVENT_BYTES
+
+class ImportTest(TestCase):
+    def test_lazy_boto3(self):
+        ''' importing main does not import boto3 '''
+        code = 'import sys, main; sys.exit("boto3" in sys.modules)'
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        subprocess.run([sys.executable, '-c', code], cwd=root, check=True)
 
 class RegionTest(TestCase):
     ''' tests for get_region() '''
@@ -35,7 +47,6 @@ class CloudWatchClientTest(TestCase):
     CURSOR_CONTENT = open(CURSOR).read().rstrip('\n')
     GROUP = 'log group'
     STREAM = 'log stream '
-    REGION = 'us-east-1'
     tskey = '__REALTIME_TIMESTAMP'
 
     def make_client(self, cursor='/dev/null', group_format='group', stream_format='stream'):
@@ -43,7 +54,6 @@ class CloudWatchClientTest(TestCase):
 
     def setUp(self):
         super().setUp()
-        os.environ['AWS_DEFAULT_REGION'] = self.REGION
         self.client = self.make_client(self.CURSOR, self.GROUP, self.STREAM)
         self.cwl = self.client.client = create_autospec(self.client.client)
 
@@ -52,22 +62,104 @@ class CloudWatchClientTest(TestCase):
 
         with patch('boto3.client', autospec=True) as boto3:
             with patch('main.get_region', autospec=True) as get_region:
-                client = self.make_client(sentinel.cursor, sentinel.group, sentinel.stream)
+                client = self.make_client(sentinel.cursor, 'group {a}', 'stream {b}')
                 self.assertIs(client.cursor_path, sentinel.cursor)
-                self.assertIs(client.log_group_format, sentinel.group)
-                self.assertIs(client.log_stream_format, sentinel.stream)
+                self.assertEqual(client.log_group_format, 'group {a}')
+                self.assertEqual(client.log_stream_format, 'stream {b}')
+                self.assertEqual(client.matches, ())
+                # compiles the formats
+                self.assertEqual(client.group_formatter(dict(a=1)), 'group 1')
+                self.assertEqual(client.stream_formatter(dict(b=2)), 'stream 2')
                 # sets up the cwlogs client
                 self.assertEqual(client.client, boto3.return_value)
-                boto3.assert_called_once_with('logs', region_name=get_region.return_value)
+                boto3.assert_called_once_with('logs', region_name=get_region.return_value, config=ANY)
+                config = boto3.call_args[1]['config']
+                self.assertEqual(config.retries, BOTO_CONFIG['retries'])
+                self.assertEqual(config.max_pool_connections, UPLOAD_WORKERS)
+                # upload threads are reused
+                self.assertIsInstance(client.executor, ThreadPoolExecutor)
+                self.assertEqual(client.executor._max_workers, UPLOAD_WORKERS)
+
+    def test_init_workers(self):
+        ''' the number of upload threads is configurable '''
+
+        with patch('boto3.client', autospec=True) as boto3:
+            client = CloudWatchClient('/dev/null', 'group', 'stream', workers=3)
+            self.assertEqual(boto3.call_args[1]['config'].max_pool_connections, 3)
+            self.assertEqual(client.executor._max_workers, 3)
+            self.assertEqual(client.max_pending_uploads, 6)
 
     def test_save_cursor(self):
         ''' test the cursor is saved to the file '''
 
         cursor = 'blargh'
-        with tempfile.NamedTemporaryFile('r') as file:
-            client = self.make_client(file.name)
-            client.save_cursor(cursor)
-            self.assertEqual(file.read(), cursor)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cursor')
+            with open(path, 'w') as file:
+                file.write('old cursor')
+
+            client = self.make_client(path)
+            with patch('os.fsync', wraps=os.fsync) as fsync:
+                client.save_cursor(cursor)
+            # the file and then its directory
+            self.assertEqual(fsync.call_count, 2)
+
+            with open(path) as file:
+                self.assertEqual(file.read(), cursor)
+            # the temp file is moved into place
+            self.assertEqual(os.listdir(tmpdir), ['cursor'])
+
+    def test_known(self):
+        ''' test the known groups are saved and loaded, streams are only kept in memory '''
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'known')
+            client = CloudWatchClient('/dev/null', 'group', 'stream', known_path=path)
+            self.assertEqual(client.known, {})
+            self.assertEqual(client.remember('a'), set())
+            self.assertEqual(client.remember('b', 'x'), {'x'})
+            self.assertEqual(client.remember('b', 'y'), {'x', 'y'})
+            with open(path) as file:
+                self.assertEqual(json.load(file), ['a', 'b'])
+
+            client = CloudWatchClient('/dev/null', 'group', 'stream', known_path=path)
+            self.assertEqual(client.known, dict(a=set(), b=set()))
+
+    def test_known_new_streams(self):
+        ''' test the known file is only written for new groups '''
+
+        with patch('main.write_file_atomically') as write:
+            client = CloudWatchClient('/dev/null', 'group', 'stream', known_path='known')
+            client.remember('a', 'x')
+            client.remember('a', 'y')
+            client.remember('a')
+        write.assert_called_once_with('known', '["a"]')
+
+    def test_known_old_format(self):
+        ''' test the groups are loaded from files that also list the streams '''
+
+        with tempfile.NamedTemporaryFile('w') as file:
+            json.dump(dict(a=['x'], b=[]), file)
+            file.flush()
+            client = CloudWatchClient('/dev/null', 'group', 'stream', known_path=file.name)
+            self.assertEqual(client.known, dict(a=set(), b=set()))
+
+    def test_known_no_path(self):
+        ''' test the known groups and streams are only kept in memory without a path '''
+
+        with patch('main.write_file_atomically') as write:
+            self.client.remember('a', 'x')
+        write.assert_not_called()
+        self.assertEqual(self.client.known, dict(a={'x'}))
+
+    def test_known_invalid(self):
+        ''' test an unreadable known file is ignored '''
+
+        with tempfile.NamedTemporaryFile('w') as file:
+            file.write('not json')
+            file.flush()
+            client = CloudWatchClient('/dev/null', 'group', 'stream', known_path=file.name)
+            self.assertEqual(client.known, {})
 
     def test_load_cursor(self):
         ''' test the cursor is loaded from the file '''
@@ -85,30 +177,91 @@ class CloudWatchClientTest(TestCase):
         client = self.make_client('/non/existent/file')
         self.assertIsNone(client.load_cursor())
 
-    def test_retain_message(self):
-        ''' test retain_message() '''
-
-        # keep messages newer than 14 days
-        self.assertTrue(CloudWatchClient.retain_message(dict(__REALTIME_TIMESTAMP=datetime.now() - timedelta(days=1))))
-        # drop messages older than 14 days
-        self.assertFalse(CloudWatchClient.retain_message(dict(__REALTIME_TIMESTAMP=datetime.now() - timedelta(days=14))))
-        # keep empty message breakers
-        self.assertTrue(CloudWatchClient.retain_message({}))
-
     def test_make_message(self):
-        ''' test make_message() serialises the data '''
+        ''' test make_sized_message() serialises the data '''
 
         ts = 123456789
-        msg = [('__REALTIME_TIMESTAMP', datetime.fromtimestamp(ts)), ('a', 'abc'), ('b', 123), ('c', datetime.now()), ('d', uuid.uuid4()), ('e', object()), ]
-        result = CloudWatchClient.make_message(dict(msg))
+        now = datetime.now()
+        u = uuid.uuid4()
+        msg = dict(__REALTIME_TIMESTAMP=datetime.fromtimestamp(ts), a='abc', b=123, c=now, d=u, e=object())
+        result, size = CloudWatchClient.make_sized_message(msg)
 
         # dict with 2 keys
         self.assertIsInstance(result, dict)
         self.assertEqual(len(result), 2)
 
         self.assertEqual(result['timestamp'], ts*1000)
-        # only first 5 fields are serialisable
-        self.assertEqual(json.loads(result['message']), json.loads(json.dumps(dict(msg[:5]), cls=JournalMsgEncoder)))
+        # datetimes become timestamps, uuids become strings and unserialisable values are dropped
+        self.assertEqual(json.loads(result['message']), dict(__REALTIME_TIMESTAMP=ts, a='abc', b=123, c=now.timestamp(), d=str(u)))
+
+    def test_make_message_subclasses(self):
+        ''' test make_sized_message() serialises subclasses of the known types '''
+
+        class Timestamp(datetime):
+            pass
+        now = datetime.now()
+        msg = dict(__REALTIME_TIMESTAMP=now, a=Timestamp.fromtimestamp(123), b=True)
+        result, size = CloudWatchClient.make_sized_message(msg)
+        self.assertEqual(json.loads(result['message']), dict(__REALTIME_TIMESTAMP=now.timestamp(), a=123, b=True))
+
+    def test_make_sized_message(self):
+        ''' test make_sized_message() returns the size in utf-8 bytes '''
+
+        msg = dict(__REALTIME_TIMESTAMP=datetime.now(), a='caf\u00e9 \u2603')
+        event, size = CloudWatchClient.make_sized_message(msg)
+        self.assertEqual(size, len(event['message'].encode('utf-8')))
+        with patch('main.orjson', None):
+            event, size = CloudWatchClient.make_sized_message(msg)
+        self.assertEqual(size, len(event['message'].encode('utf-8')))
+
+    def test_make_message_truncated(self):
+        ''' test make_sized_message() truncates messages too big for a single event '''
+
+        msg = dict(__REALTIME_TIMESTAMP=datetime.now(), MESSAGE='a\n' * MAX_EVENT_BYTES, OTHER='b' * 100)
+        for orjson in (main.orjson, None):
+            with patch('main.orjson', orjson), patch('sys.stderr'):
+                event, size = CloudWatchClient.make_sized_message(msg)
+            self.assertLessEqual(size + EVENT_OVERHEAD_BYTES, MAX_EVENT_BYTES)
+            self.assertEqual(size, len(event['message'].encode('utf-8')))
+            message = json.loads(event['message'])
+            self.assertTrue(msg['MESSAGE'].startswith(message['MESSAGE'].partition('...[truncated ')[0]))
+            self.assertRegex(message['MESSAGE'], r'\.\.\.\[truncated \d+ chars\]$')
+            # the other fields are kept
+            self.assertEqual(message['OTHER'], msg['OTHER'])
+
+    def test_make_message_truncated_multibyte(self):
+        ''' test make_sized_message() only truncates as much as needed when characters take up several bytes '''
+
+        for values in (dict(MESSAGE='\u2603' * 200000, OTHER='\u2603' * 150000), dict(MESSAGE='\x01' * 100000)):
+            msg = dict(__REALTIME_TIMESTAMP=datetime.now(), **values)
+            for orjson in (main.orjson, None):
+                with patch('main.orjson', orjson), patch('sys.stderr'):
+                    event, size = CloudWatchClient.make_sized_message(msg)
+                self.assertLessEqual(size + EVENT_OVERHEAD_BYTES, MAX_EVENT_BYTES)
+                self.assertEqual(size, len(event['message'].encode('utf-8')))
+                # the event is filled almost to the limit
+                self.assertGreater(size + EVENT_OVERHEAD_BYTES, MAX_EVENT_BYTES - 100)
+                message = json.loads(event['message'])
+                for k, v in values.items():
+                    self.assertTrue(v.startswith(message[k].partition('...[truncated ')[0]))
+
+    def test_make_message_not_truncated(self):
+        ''' test make_sized_message() does not truncate messages that fit in an event '''
+
+        msg = dict(__REALTIME_TIMESTAMP=datetime.now(), MESSAGE='a' * (MAX_EVENT_BYTES // 2))
+        with patch.object(CloudWatchClient, 'truncate_values') as truncate_values:
+            CloudWatchClient.make_sized_message(msg)
+        truncate_values.assert_not_called()
+
+    def test_make_message_no_orjson(self):
+        ''' test make_sized_message() falls back to the json module '''
+
+        now = datetime.now()
+        u = uuid.uuid4()
+        msg = dict(__REALTIME_TIMESTAMP=now, a='abc', b=123, d=u)
+        with patch('main.orjson', None):
+            result, size = CloudWatchClient.make_sized_message(msg)
+        self.assertEqual(result['message'], json.dumps(dict(msg, __REALTIME_TIMESTAMP=now.timestamp(), d=str(u))))
 
     def test_log_group_client(self):
         ''' test log group client creation '''
@@ -129,66 +282,186 @@ class CloudWatchClientTest(TestCase):
         ''' test making group and stream names from msg '''
 
         msg = {}
-        names = [self.GROUP, self.STREAM]
-        with patch('main.Format', side_effect=names) as formatter:
-            group, stream = self.client.get_group_stream(msg)
+        with patch.object(self.client, 'group_formatter', return_value=self.GROUP) as group_formatter:
+            with patch.object(self.client, 'stream_formatter', return_value=self.STREAM) as stream_formatter:
+                group, stream = self.client.get_group_stream(msg)
 
+        group_formatter.assert_called_once_with(msg)
+        stream_formatter.assert_called_once_with(msg)
         self.assertIsInstance(group, LogGroupClient)
         self.assertEqual(group.log_group, self.GROUP)
         self.assertEqual(stream, self.STREAM)
 
+    def test_get_group_stream_cached(self):
+        ''' test group and stream names are cached on the fields the formats use '''
+
+        client = self.make_client('/dev/null', '{a}', '{b|"other"}')
+        self.assertEqual(client.format_fields, ('a', 'b'))
+        with patch.object(client, 'make_group_stream', return_value=sentinel.names) as make_group_stream:
+            self.assertIs(client.get_group_stream(dict(a=1, b=2, c=3)), sentinel.names)
+            self.assertIs(client.get_group_stream(dict(a=1, b=2, c=4)), sentinel.names)
+            self.assertIs(client.get_group_stream(dict(a=1, c=4)), sentinel.names)
+
+        self.assertEqual(make_group_stream.call_args_list, [call(dict(a=1, b=2)), call(dict(a=1))])
+
+    def test_get_group_stream_not_cached(self):
+        ''' test group and stream names are not cached if the fields used are unknown or unhashable '''
+
+        msg = dict(a=[1], b=2)
+        for group_format in ('{a}', '{a[0]}'):
+            client = self.make_client('/dev/null', group_format, '{b}')
+            with patch.object(client, 'make_group_stream', return_value=sentinel.names) as make_group_stream:
+                self.assertIs(client.get_group_stream(msg), sentinel.names)
+                self.assertIs(client.get_group_stream(msg), sentinel.names)
+            self.assertEqual(make_group_stream.call_args_list, [call(msg), call(msg)])
+
+    def make_msg(self, cursor='cursor', **kwargs):
+        return dict({self.tskey: datetime.now(), '__CURSOR': cursor}, **kwargs)
+
+    def events(self, msgs):
+        return [CloudWatchClient.make_sized_message(m)[0] for m in msgs]
+
     def test_group_messages_empty_msg(self):
-        ''' group_messages() should break on empty messages '''
+        ''' group_messages() should break on empty messages and mark the journal as idle '''
 
-        msg = {self.tskey: datetime.now()}
+        msg = self.make_msg()
         msgs = [msg] * 5 + [{}] + [msg] * 4 + [{}, {}] + [msg] * 3 + [{}]
         key = ('group', 'stream')
+        idle = (None, None, 'cursor')
         with patch.object(self.client, 'get_group_stream', return_value=key):
             chunks = self.client.group_messages(msgs)
             self.assertEqual(
                 list(chunks),
-                [(key, [msg]*5), (key, [msg]*4), (key, [msg]*3)]
+                [(key, self.events([msg]*5), 'cursor'), idle, (key, self.events([msg]*4), 'cursor'), idle, idle, (key, self.events([msg]*3), 'cursor'), idle]
             )
 
+    def test_group_messages_idle_all_flushed(self):
+        ''' group_messages() marks the journal as idle with the latest cursor even if every batch was already flushed '''
+
+        msgs = [self.make_msg(cursor=0), self.make_msg(cursor=1), {}]
+        key = ('group', 'stream')
+        with patch.object(self.client, 'get_group_stream', return_value=key):
+            chunks = self.client.group_messages(msgs, maxlen=2)
+            self.assertEqual(list(chunks), [(key, self.events(msgs[:2]), 1), (None, None, 1)])
+
     def test_group_messages_max_len(self):
-        ''' group_messages() should yield batches of up to size 10 '''
+        ''' group_messages() should yield batches of up to maxlen '''
+
+        msgs = [self.make_msg(cursor=i) for i in range(25)]
+        key = ('group', 'stream')
+        with patch.object(self.client, 'get_group_stream', return_value=key):
+            chunks = self.client.group_messages(msgs, maxlen=10)
+            self.assertEqual(
+                list(chunks),
+                [(key, self.events(msgs[:10]), 9), (key, self.events(msgs[10:20]), 19), (key, self.events(msgs[20:]), 24)]
+            )
+
+    def test_group_messages_max_bytes(self):
+        ''' group_messages() should yield batches of up to maxbytes '''
 
-        msg = {self.tskey: datetime.now()}
+        msg = self.make_msg()
         msgs = [msg] * 25
+        size = CloudWatchClient.make_sized_message(msg)[1] + EVENT_OVERHEAD_BYTES
         key = ('group', 'stream')
         with patch.object(self.client, 'get_group_stream', return_value=key):
-            chunks = self.client.group_messages(msgs)
+            chunks = self.client.group_messages(msgs, maxbytes=size*10 + 1)
             self.assertEqual(
                 list(chunks),
-                [(key, [msg]*10), (key, [msg]*10), (key, [msg]*5)]
+                [(key, self.events([msg]*10), 'cursor'), (key, self.events([msg]*10), 'cursor'), (key, self.events([msg]*5), 'cursor')]
             )
 
     def test_group_messages_max_timespan(self):
         ''' group_messages() should yield batches not spanning > 24h '''
 
         now = datetime.now()
-        msgs = [{self.tskey: now + timedelta(hours=i*6)} for i in range(10)]
+        msgs = [{self.tskey: now + timedelta(hours=i*6), '__CURSOR': i} for i in range(10)]
         key = ('group', 'stream')
         with patch.object(self.client, 'get_group_stream', return_value=key):
             chunks = self.client.group_messages(msgs)
             self.assertEqual(
                 list(chunks),
-                [(key, msgs[:4]), (key, msgs[4:8]), (key, msgs[8:])]
+                [(key, self.events(msgs[:4]), 3), (key, self.events(msgs[4:8]), 7), (key, self.events(msgs[8:]), 9)]
             )
 
     def test_group_messages_by_group_stream(self):
         ''' group_messages() should by the log group and stream '''
 
-        msg = {self.tskey: datetime.now()}
-        msgs = [msg] * 25
+        msgs = [self.make_msg(cursor=i) for i in range(25)]
         keys = [i//8 for i in range(25)]
         with patch.object(self.client, 'get_group_stream', side_effect=keys):
             chunks = self.client.group_messages(msgs)
             self.assertEqual(
                 list(chunks),
-                [(0, msgs[:8]), (1, msgs[8:16]), (2, msgs[16:24]), (3, msgs[24:])]
+                [(0, self.events(msgs[:8]), 7), (1, self.events(msgs[8:16]), 15), (2, self.events(msgs[16:24]), 23), (3, self.events(msgs[24:]), 24)]
+            )
+
+    def test_group_messages_interleaved(self):
+        ''' group_messages() batches each group/stream separately, the cursor only covers messages already yielded '''
+
+        msgs = [self.make_msg(cursor=i) for i in range(10)]
+        keys = [i % 2 for i in range(10)]
+        with patch.object(self.client, 'get_group_stream', side_effect=keys):
+            chunks = self.client.group_messages(msgs, maxlen=3)
+            self.assertEqual(list(chunks), [
+                # message 1 onwards is still waiting in the other batch
+                (0, self.events(msgs[0:6:2]), 0),
+                (1, self.events(msgs[1:6:2]), 5),
+                (0, self.events(msgs[6::2]), 6),
+                (1, self.events(msgs[7::2]), 9),
+            ])
+
+    def test_group_messages_max_buffered(self):
+        ''' group_messages() flushes the oldest batch when too much is held back '''
+
+        msgs = [self.make_msg(cursor=i) for i in range(5)]
+        size = CloudWatchClient.make_sized_message(msgs[0])[1] + EVENT_OVERHEAD_BYTES
+        with patch.object(self.client, 'get_group_stream', side_effect=[0, 1, 2, 0, 1]):
+            chunks = self.client.group_messages(msgs, maxbuffered=size * 2)
+            self.assertEqual(list(chunks), [
+                (0, self.events(msgs[:1]), 0),
+                (1, self.events(msgs[1:2]), 1),
+                (2, self.events(msgs[2:3]), 2),
+                (0, self.events(msgs[3:4]), 3),
+                (1, self.events(msgs[4:5]), 4),
+            ])
+
+    def test_group_messages_cutoff(self):
+        ''' group_messages() should drop messages from before the cutoff '''
+
+        now = datetime.now()
+        old = self.make_msg(**{self.tskey: now - timedelta(days=14)})
+        new = self.make_msg(**{self.tskey: now - timedelta(days=1)})
+        msgs = [old, new, old, {}, new, old]
+        key = ('group', 'stream')
+        with patch.object(self.client, 'get_group_stream', return_value=key):
+            chunks = self.client.group_messages(msgs, OLDEST_LOG_RETENTION)
+            self.assertEqual(
+                list(chunks),
+                [(key, self.events([new]), 'cursor'), (None, None, 'cursor'), (key, self.events([new]), 'cursor')]
             )
 
+    @patch('main.CUTOFF_REFRESH_MESSAGES', 2)
+    def test_group_messages_cutoff_refresh(self):
+        ''' group_messages() recomputes the cutoff every so often and after the journal is idle '''
+
+        msgs = [self.make_msg(**{self.tskey: datetime.now()}) for _ in range(5)]
+        msgs.insert(3, {})
+        with patch.object(self.client, 'get_group_stream', return_value=('group', 'stream')):
+            with patch('main.datetime.datetime', wraps=datetime) as dt:
+                list(self.client.group_messages(msgs, OLDEST_LOG_RETENTION))
+        # before the 1st and 3rd messages, then the first message after the breaker
+        self.assertEqual(dt.now.call_count, 3)
+
+    def test_group_messages_lazy(self):
+        ''' group_messages() should consume the messages lazily '''
+
+        msg = self.make_msg()
+        key = ('group', 'stream')
+        with patch.object(self.client, 'get_group_stream', return_value=key):
+            # the journal never ends
+            chunks = self.client.group_messages(itertools.repeat(msg), maxlen=10)
+            self.assertEqual(next(chunks), (key, self.events([msg]*10), 'cursor'))
+
     def test_group_messages_empty(self):
         ''' group_messages() with no messages '''
 
@@ -198,38 +471,139 @@ class CloudWatchClientTest(TestCase):
     def test_put_log_messages(self):
         ''' test put_log_messages() '''
 
-        messages = [dict(a='abc'), dict(b='xyz', __CURSOR=sentinel.cursor)]
         events = [sentinel.msg1, sentinel.msg2]
-        with patch.object(self.client, 'make_message', side_effect=events, autospec=True) as make_message:
-            with patch.object(self.client, 'save_cursor', autospec=True) as save_cursor:
-                self.client.put_log_messages(sentinel.group, sentinel.stream, sentinel.token, messages)
+        result = self.client.put_log_messages(sentinel.group, sentinel.stream, events)
+        self.assertIs(result, self.cwl.put_log_events.return_value)
 
+        # no sequence token is sent
         self.cwl.put_log_events.assert_called_once_with(
             logGroupName=sentinel.group,
             logStreamName=sentinel.stream,
             logEvents=events,
-            sequenceToken=sentinel.token,
         )
-        # saves the cursor once finished
-        save_cursor.assert_called_once_with(sentinel.cursor)
 
-    def test_put_log_messages_no_token(self):
-        ''' test put_log_messages() when no sequence token given '''
-
-        messages = [dict(a='abc'), dict(b='xyz', __CURSOR=sentinel.cursor)]
-        events = [sentinel.msg1, sentinel.msg2]
-        with patch.object(self.client, 'make_message', side_effect=events, autospec=True) as make_message:
+    @patch('main.CURSOR_SAVE_INTERVAL', 0)
+    def test_save_uploaded_cursor(self):
+        ''' save_uploaded_cursor() saves the cursor of the latest upload where all before it have finished '''
+
+        futures = [Future() for _ in range(4)]
+        uploads = collections.deque(zip(futures, [sentinel.cursor1, sentinel.cursor2, sentinel.cursor3, sentinel.cursor4]))
+        futures[0].set_result(None)
+        futures[2].set_result(None)
+        with patch.object(self.client, 'save_cursor', autospec=True) as save_cursor:
+            self.client.save_uploaded_cursor(uploads)
+            save_cursor.assert_called_once_with(sentinel.cursor1)
+            self.assertEqual(len(uploads), 3)
+
+            # nothing new finished in order
+            save_cursor.reset_mock()
+            futures[3].set_result(None)
+            self.client.save_uploaded_cursor(uploads)
+            save_cursor.assert_not_called()
+
+            futures[1].set_result(None)
+            self.client.save_uploaded_cursor(uploads)
+            save_cursor.assert_called_once_with(sentinel.cursor4)
+            self.assertEqual(len(uploads), 0)
+
+    @patch('time.monotonic')
+    def test_save_uploaded_cursor_interval(self, monotonic):
+        ''' save_uploaded_cursor() saves the cursor at most every CURSOR_SAVE_INTERVAL '''
+
+        futures = [Future() for _ in range(3)]
+        for f in futures:
+            f.set_result(None)
+        uploads = collections.deque()
+        with patch.object(self.client, 'save_cursor', autospec=True) as save_cursor:
+            for now, future, cursor in zip([100, 101, 100 + CURSOR_SAVE_INTERVAL], futures, [sentinel.cursor1, sentinel.cursor2, sentinel.cursor3]):
+                monotonic.return_value = now
+                uploads.append((future, cursor))
+                self.client.save_uploaded_cursor(uploads)
+        self.assertEqual(save_cursor.call_args_list, [call(sentinel.cursor1), call(sentinel.cursor3)])
+
+    def test_save_uploaded_cursor_wait(self):
+        ''' save_uploaded_cursor() waits for all uploads '''
+
+        future = Future()
+        uploads = collections.deque([(future, sentinel.cursor)])
+        with patch.object(future, 'result', autospec=True) as result:
             with patch.object(self.client, 'save_cursor', autospec=True) as save_cursor:
-                self.client.put_log_messages(sentinel.group, sentinel.stream, None, messages)
+                self.client.save_uploaded_cursor(uploads, wait=True)
+        result.assert_called_once_with()
+        save_cursor.assert_called_once_with(sentinel.cursor)
 
-        self.cwl.put_log_events.assert_called_once_with(
-            logGroupName=sentinel.group,
-            logStreamName=sentinel.stream,
-            logEvents=events,
-        )
-        # saves the cursor once finished
+    def test_save_uploaded_cursor_wait_saved(self):
+        ''' save_uploaded_cursor() does not save the same cursor again while the journal is quiet '''
+
+        with patch.object(self.client, 'save_cursor', autospec=True) as save_cursor:
+            self.client.save_uploaded_cursor(collections.deque(), wait=True, cursor=sentinel.cursor)
+            self.client.cursor_saved_at = float('-inf')
+            self.client.save_uploaded_cursor(collections.deque(), wait=True, cursor=sentinel.cursor)
         save_cursor.assert_called_once_with(sentinel.cursor)
 
+    def test_save_uploaded_cursor_wait_interval(self):
+        ''' save_uploaded_cursor() waits for all uploads but still only saves the cursor every so often '''
+
+        future = Future()
+        future.set_result(None)
+        uploads = collections.deque([(future, sentinel.cursor)])
+        self.client.cursor_saved_at = main.time.monotonic()
+        with patch.object(self.client, 'save_cursor', autospec=True) as save_cursor:
+            self.client.save_uploaded_cursor(uploads, wait=True)
+        save_cursor.assert_not_called()
+        self.assertFalse(uploads)
+        self.assertEqual(self.client.pending_cursor, sentinel.cursor)
+
+    def test_save_uploaded_cursor_wait_cursor(self):
+        ''' save_uploaded_cursor() saves the given cursor once all uploads have finished '''
+
+        future = Future()
+        future.set_result(None)
+        uploads = collections.deque([(future, sentinel.cursor1)])
+        with patch.object(self.client, 'save_cursor', autospec=True) as save_cursor:
+            self.client.save_uploaded_cursor(uploads, wait=True, cursor=sentinel.cursor2)
+        save_cursor.assert_called_once_with(sentinel.cursor2)
+        self.assertFalse(uploads)
+
+    def test_upload_journal_logs_matches(self):
+        ''' test upload_journal_logs() passes on the journal matches '''
+
+        self.client.matches = ['A=1', 'B=2']
+        journal = systemd.journal.Reader(path=os.getcwd())
+        with patch('systemd.journal.Reader', return_value=journal):
+            with patch('main.JournaldClient', MagicMock(autospec=True)) as reader:
+                with patch.object(self.client, 'group_messages', return_value=[]):
+                    self.client.upload_journal_logs(os.getcwd())
+
+        # creates reader
+        reader.assert_called_once_with(journal, self.CURSOR_CONTENT, ['A=1', 'B=2'])
+
+    def test_save_uploaded_cursor_max_pending(self):
+        ''' save_uploaded_cursor() waits for the oldest uploads when there are too many '''
+
+        self.client.max_pending_uploads = 1
+        futures = [Future(), Future()]
+        uploads = collections.deque(zip(futures, [sentinel.cursor1, sentinel.cursor2]))
+        with patch.object(futures[0], 'result', autospec=True) as result:
+            with patch.object(self.client, 'save_cursor', autospec=True) as save_cursor:
+                self.client.save_uploaded_cursor(uploads)
+        result.assert_called_once_with()
+        save_cursor.assert_called_once_with(sentinel.cursor1)
+        self.assertEqual(list(uploads), [(futures[1], sentinel.cursor2)])
+
+    def test_save_uploaded_cursor_error(self):
+        ''' save_uploaded_cursor() raises failed uploads without saving their cursor '''
+
+        futures = [Future(), Future()]
+        uploads = collections.deque(zip(futures, [sentinel.cursor1, sentinel.cursor2]))
+        futures[0].set_exception(ValueError())
+        futures[1].set_result(None)
+        with patch.object(self.client, 'save_cursor', autospec=True) as save_cursor:
+            with self.assertRaises(ValueError):
+                self.client.save_uploaded_cursor(uploads)
+        save_cursor.assert_not_called()
+
+    @patch('main.CURSOR_SAVE_INTERVAL', 0)
     def test_upload_journal_logs(self):
         ''' test upload_journal_logs() '''
 
@@ -240,19 +614,62 @@ class CloudWatchClientTest(TestCase):
             with patch('main.JournaldClient', MagicMock(autospec=True)) as reader:
                 reader.return_value.__iter__.return_value = [sentinel.msg1, sentinel.msg2, sentinel.msg3, sentinel.msg4]
 
-                with patch.multiple(self.client, retain_message=DEFAULT, group_messages=DEFAULT):
+                with patch.object(self.client, 'group_messages', autospec=True) as group_messages:
                     log_group1 = Mock()
                     log_group2 = Mock()
-                    self.client.retain_message.side_effect = [True, False, True, True]
-                    self.client.group_messages.return_value = [
-                        ((log_group1, 'stream1'), [sentinel.msg1]),
-                        ((log_group2, 'stream2'), [sentinel.msg3, sentinel.msg4]),
+                    group_messages.return_value = [
+                        ((log_group1, 'stream1'), [sentinel.event1], sentinel.cursor1),
+                        ((log_group2, 'stream2'), [sentinel.event3, sentinel.event4], sentinel.cursor2),
+                        (None, None, sentinel.cursor2),
                     ]
 
-                    self.client.upload_journal_logs(os.getcwd())
+                    with patch.object(self.client, 'save_cursor', autospec=True) as save_cursor:
+                        self.client.upload_journal_logs(os.getcwd())
 
         # creates reader
-        reader.assert_called_once_with(journal.return_value, self.CURSOR_CONTENT)
+        reader.assert_called_once_with(journal.return_value, self.CURSOR_CONTENT, ())
+        # groups messages newer than 14 days
+        group_messages.assert_called_once_with(reader.return_value, OLDEST_LOG_RETENTION)
         # uploads log messages
-        log_group1.log_messages.assert_called_once_with('stream1', [sentinel.msg1])
-        log_group2.log_messages.assert_called_once_with('stream2', [sentinel.msg3, sentinel.msg4])
+        log_group1.log_messages.assert_called_once_with('stream1', [sentinel.event1])
+        log_group2.log_messages.assert_called_once_with('stream2', [sentinel.event3, sentinel.event4])
+        # saves the cursor of the last upload
+        self.assertEqual(save_cursor.call_args_list[-1], call(sentinel.cursor2))
+
+    def test_upload_journal_logs_idle(self):
+        ''' test upload_journal_logs() submits every batch flushed when the journal is idle before waiting for them '''
+
+        class Journal:
+            def __init__(self, msgs):
+                self.msgs = iter(msgs)
+                self.wait = False
+            def __iter__(self):
+                return self
+            def __next__(self):
+                msg = next(self.msgs)
+                self.wait = not msg
+                return msg
+
+        order = []
+        def submit(fn, stream, log_events):
+            order.append(('submit', stream))
+            future = Mock(spec=Future)
+            future.done.return_value = False
+            future.result.side_effect = lambda: order.append(('result', stream))
+            return future
+
+        log_group = Mock()
+        msgs = [self.make_msg(cursor=i, stream=str(i)) for i in range(3)] + [{}]
+        journal = systemd.journal.Reader(path=os.getcwd())
+        with patch('systemd.journal.Reader', return_value=journal):
+            with patch('main.JournaldClient', return_value=Journal(msgs)):
+                with patch.object(self.client, 'get_group_stream', side_effect=lambda m: (log_group, m['stream'])):
+                    with patch.object(self.client.executor, 'submit', side_effect=submit):
+                        with patch.object(self.client, 'save_cursor', autospec=True) as save_cursor:
+                            self.client.upload_journal_logs(os.getcwd())
+
+        self.assertEqual(order, [
+            ('submit', '0'), ('submit', '1'), ('submit', '2'),
+            ('result', '0'), ('result', '1'), ('result', '2'),
+        ])
+        save_cursor.assert_called_once_with(2)
@@ -1,10 +1,10 @@
 from unittest import TestCase
-from unittest.mock import patch, mock_open, Mock
+from unittest.mock import patch, Mock, ANY
 import os
 import json
-import urllib.request
+import urllib3
 
-from main import Format, IDENTITY_DOC_URL, get_instance_identity_document
+from main import Format, Formatter, IDENTITY_DOC_URL, IMDS_TOKEN_URL, IMDS_TIMEOUT, IMDS_HTTP, get_instance_identity_document, get_imds_token, normalise_unit
 
 IDENTITY_DOC_STR = b'''{
   "devpayProductCodes" : null,
@@ -24,10 +24,21 @@ IDENTITY_DOC_STR = b'''{
 }
 '''
 
-IDENTITY_DOC = json.loads(IDENTITY_DOC_STR.decode('utf-8'))
+IDENTITY_DOC = json.loads(IDENTITY_DOC_STR)
 
 @patch('main.get_instance_identity_document', return_value=IDENTITY_DOC, autospec=True)
 class FormatterTest(TestCase):
+    def test_parse_key(self, _):
+        ''' test keys are split into alternatives up to the first literal '''
+        self.assertEqual(Formatter.parse_key('a|$b|"c"|d'), ((None, 'a'), (None, '$b'), ('c', None)))
+
+    def test_key_parsed_once(self, _):
+        ''' test the getters for a key are reused '''
+        Formatter.key_getters.cache_clear()
+        self.assertEqual(Format('{a|b} {a|b}', b=1), '1 1')
+        self.assertEqual(Format('{a|b}', a=2), '2')
+        self.assertEqual(Formatter.key_getters.cache_info().misses, 1)
+
     def test_default_formatting(self, _):
         ''' test formatting is same as default '''
         for fmt, kwargs in [
@@ -84,23 +95,145 @@ class FormatterTest(TestCase):
         self.assertEqual(Format('xyz {$other}', **{'$other': 'hello'}), 'xyz hello')
         self.assertRaises(KeyError, Format, 'xyz {$not_found}')
 
+@patch('main.get_instance_identity_document', return_value=IDENTITY_DOC, autospec=True)
+class CompiledFormatterTest(TestCase):
+    def compile(self, fmt):
+        return Formatter().compile(fmt)
+
+    def test_same_as_format(self, _):
+        ''' test compiled formats give the same result as Format '''
+        for fmt, kwargs in [
+            ['string', {}],
+            ['abc {d}', {'d': 123}],
+            ['{b} {a}', {'a': 123, 'b': 456}],
+            ['formatting {x:03}', {'x': 2}],
+            ['conversion {x!r}', {'x': 'abc'}],
+            ['escaped {{x}} {x}', {'x': 'abc'}],
+            ['xyz {a|b|c} 123', {'b': 2, 'c': 3}],
+            ['xyz {a|b|"hello"} 123', {}],
+            ['xyz {invalid|$region}', {}],
+            ['xyz {$unit}', {'_SYSTEMD_UNIT': 'systemd_unit@arg.service'}],
+            ['xyz {$docker_container}', {'_SYSTEMD_UNIT': 'docker.service', 'CONTAINER_NAME': 'container'}],
+            ['xyz {$other}', {'$other': 'hello'}],
+            ['nested {x:{y}}', {'x': 2, 'y': '03'}],
+            ['attribute {x.real}', {'x': 2}],
+        ]:
+            self.assertEqual(self.compile(fmt)(kwargs), Format(fmt, **kwargs))
+
+    def test_env_vars(self, _):
+        ''' test environment variables are read when compiling '''
+        with patch.dict(os.environ, ENV_VAR='hello'):
+            fmt = self.compile('xyz {$ENV_VAR} {$unit|$ENV_VAR}')
+        self.assertEqual(fmt({}), 'xyz hello hello')
+        self.assertEqual(fmt({'_SYSTEMD_UNIT': 'unit'}), 'xyz hello unit')
+
+    def test_identity_doc_read_once(self, get_instance_identity_document):
+        ''' test the identity doc is only read when compiling '''
+        fmt = self.compile('xyz {$region} {$instanceId}')
+        get_instance_identity_document.reset_mock()
+        for _ in range(3):
+            self.assertEqual(fmt({}), 'xyz {region} {instanceId}'.format(**IDENTITY_DOC))
+        get_instance_identity_document.assert_not_called()
+
+    def test_fields(self, _):
+        ''' test finding the fields a format reads '''
+        fields = Formatter().fields
+        self.assertEqual(fields('xyz {a|b|"hello"|c} {d!r:>3}'), {'a', 'b', 'd'})
+        self.assertEqual(fields('xyz {$region} {$unit}'), {'$region', '$unit', 'USER_UNIT', '_SYSTEMD_UNIT'})
+        self.assertEqual(fields('xyz {$docker_container}'), {'$docker_container', 'CONTAINER_NAME', '_SYSTEMD_UNIT'})
+        self.assertEqual(fields('xyz'), set())
+        self.assertIsNone(fields('xyz {a.real}'))
+        self.assertIsNone(fields('xyz {a:{b}}'))
+
+    def test_missing_key(self, _):
+        ''' test KeyError when the key is not found '''
+        self.assertRaises(KeyError, self.compile('xyz {a|b|c} 123'), {})
+        self.assertRaises(KeyError, self.compile('xyz {$not_found}'), {})
+
+class NormaliseUnitTest(TestCase):
+    def test_normalise_unit(self):
+        ''' it removes the instance from templated units '''
+        self.assertEqual(normalise_unit('sshd.service'), 'sshd.service')
+        self.assertEqual(normalise_unit('sshd@127.0.0.1:22-10.0.0.1:12345.service'), 'sshd.service')
+        self.assertEqual(normalise_unit('getty@tty1.service'), 'getty.service')
+        self.assertEqual(normalise_unit('user@1000.service'), 'user.service')
+
 class InstanceIdentityDocTest(TestCase):
     DATA = dict(a=123, b='xyz')
     NULL_DATA = dict(a=123, b='xyz', c=None)
+    DATA_JSON = json.dumps(DATA).encode('utf-8')
+    NULL_DATA_JSON = json.dumps(NULL_DATA).encode('utf-8')
 
     def setUp(self):
         # clear the lru_cache every time
         get_instance_identity_document.cache_clear()
 
-    @patch('urllib.request.urlopen', mock_open())
-    def test_get_instance_identity_document(self):
-        urllib.request.urlopen.return_value.read.return_value = json.dumps(self.DATA).encode('utf-8')
-        self.assertEqual(get_instance_identity_document(), self.DATA)
-        urllib.request.urlopen.assert_called_with(IDENTITY_DOC_URL)
+    def mock_request(self, data, status=200):
+        return patch.object(IMDS_HTTP, 'request', autospec=True, return_value=Mock(status=status, data=data))
+
+    @patch('main.get_imds_token', return_value='token')
+    def test_get_instance_identity_document(self, _):
+        with self.mock_request(self.DATA_JSON) as request:
+            self.assertEqual(get_instance_identity_document(), self.DATA)
+        request.assert_called_once_with('GET', IDENTITY_DOC_URL, headers={'X-aws-ec2-metadata-token': 'token'})
+
+    @patch('main.get_imds_token', return_value=None)
+    def test_get_instance_identity_document_imdsv1(self, _):
+        ''' it makes a plain request if there is no token '''
+        with self.mock_request(self.DATA_JSON) as request:
+            self.assertEqual(get_instance_identity_document(), self.DATA)
+        request.assert_called_once_with('GET', IDENTITY_DOC_URL, headers={})
+
+    @patch('main.get_imds_token', return_value='token')
+    def test_get_instance_identity_document_error(self, _):
+        ''' it raises if the document cannot be fetched '''
+        with self.mock_request(b'', status=404):
+            self.assertRaises(urllib3.exceptions.HTTPError, get_instance_identity_document)
 
-    @patch('urllib.request.urlopen', mock_open())
-    def test_none_values_removed(self):
+    def test_get_instance_identity_document_token_timeout(self):
+        ''' it makes a plain request if the token request times out '''
+        response = Mock(status=200, data=self.DATA_JSON)
+        error = urllib3.exceptions.ReadTimeoutError(None, IMDS_TOKEN_URL, 'timed out')
+        with patch.object(IMDS_HTTP, 'request', side_effect=[error, response]) as request:
+            self.assertEqual(get_instance_identity_document(), self.DATA)
+        request.assert_called_with('GET', IDENTITY_DOC_URL, headers={})
+
+    @patch('main.get_imds_token', return_value=None)
+    def test_get_instance_identity_document_timeout(self, _):
+        ''' it raises an HTTPError if the document request times out '''
+        error = urllib3.exceptions.ReadTimeoutError(None, IDENTITY_DOC_URL, 'timed out')
+        with patch.object(IMDS_HTTP, 'request', side_effect=error):
+            self.assertRaises(urllib3.exceptions.HTTPError, get_instance_identity_document)
+
+    @patch('main.get_imds_token', return_value='token')
+    def test_none_values_removed(self, _):
         ''' it drops where values are null '''
-        urllib.request.urlopen.return_value.read.return_value = json.dumps(self.NULL_DATA).encode('utf-8')
-        self.assertEqual(get_instance_identity_document(), self.DATA)
-        urllib.request.urlopen.assert_called_with(IDENTITY_DOC_URL)
+        with self.mock_request(self.NULL_DATA_JSON):
+            self.assertEqual(get_instance_identity_document(), self.DATA)
+
+    def test_get_imds_token(self):
+        ''' it requests an IMDSv2 session token '''
+        with self.mock_request(b'token') as request:
+            self.assertEqual(get_imds_token(), 'token')
+        request.assert_called_once_with('PUT', IMDS_TOKEN_URL, headers={'X-aws-ec2-metadata-token-ttl-seconds': ANY})
+
+    def test_get_imds_token_unsupported(self):
+        ''' it returns None if the metadata service does not support tokens '''
+        with self.mock_request(b'', status=403):
+            self.assertIsNone(get_imds_token())
+
+    def test_get_imds_token_timeout(self):
+        ''' it returns None if the token request times out '''
+        error = urllib3.exceptions.ReadTimeoutError(None, IMDS_TOKEN_URL, 'timed out')
+        with patch.object(IMDS_HTTP, 'request', side_effect=error):
+            self.assertIsNone(get_imds_token())
+
+    def test_get_imds_token_connection_error(self):
+        ''' it returns None if the metadata service cannot be reached '''
+        error = urllib3.exceptions.NewConnectionError(None, 'connection refused')
+        with patch.object(IMDS_HTTP, 'request', side_effect=error):
+            self.assertIsNone(get_imds_token())
+
+    def test_timeout(self):
+        ''' the metadata service fails fast '''
+        self.assertEqual(IMDS_HTTP.connection_pool_kw['timeout'], IMDS_TIMEOUT)
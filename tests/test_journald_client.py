@@ -1,31 +1,64 @@
 from unittest import TestCase
 from unittest.mock import patch, sentinel, call, Mock, DEFAULT
-import os
-from datetime import datetime
+import shutil
+import tempfile
+from datetime import datetime, timedelta
 import systemd.journal
 
-from main import JournaldClient, OLDEST_LOG_RETENTION
+from main import JournaldClient, OLDEST_LOG_RETENTION, CURSOR_SAVE_INTERVAL
 
 class JournaldClientTest(TestCase):
-    READER = systemd.journal.Reader(path=os.getcwd())
+    # an empty directory, so opening the reader does not scan any journal files
+    JOURNAL_DIR = tempfile.mkdtemp()
+    READER = systemd.journal.Reader(path=JOURNAL_DIR)
 
-    def client(self, reader=READER, cursor=None):
-        return JournaldClient(reader, cursor)
+    @classmethod
+    def tearDownClass(cls):
+        cls.READER.close()
+        shutil.rmtree(cls.JOURNAL_DIR)
+        super().tearDownClass()
 
-    @patch.multiple(READER, seek_cursor=DEFAULT, get_next=DEFAULT, spec_set=True)
-    def test_with_cursor(self, seek_cursor, get_next):
-        ''' test when cursor exists '''
+    def client(self, reader=READER, cursor=None, matches=()):
+        return JournaldClient(reader, cursor, matches)
 
+    def mock_reader(self, *names):
+        '''
+        replaces reader methods with plain mocks on the instance, which is much cheaper than patch.multiple
+        returns a parent mock with the replacements attached
+        '''
         parent = Mock()
-        parent.attach_mock(seek_cursor, 'seek_cursor')
-        parent.attach_mock(get_next, 'get_next')
+        for name in names:
+            setattr(self.READER, name, getattr(parent, name))
+            # removing the instance attribute uncovers the original method again
+            self.addCleanup(delattr, self.READER, name)
+        return parent
+
+    def test_with_cursor(self):
+        ''' test when cursor exists '''
+
+        parent = self.mock_reader('seek_cursor', 'get_next', 'seek_realtime')
+        parent.get_next.return_value = {'__REALTIME_TIMESTAMP': datetime.now()}
         self.client(cursor=sentinel.cursor)
         # seeks to the cursor and skips first
-        parent.assert_has_calls([
+        self.assertEqual(parent.mock_calls, [
             call.seek_cursor(sentinel.cursor),
             call.get_next(),
         ])
 
+    @patch.multiple(READER, seek_cursor=DEFAULT, get_next=DEFAULT, seek_realtime=DEFAULT, spec_set=True)
+    def test_with_old_cursor(self, seek_cursor, get_next, seek_realtime):
+        ''' test when cursor is older than the retention '''
+
+        now = datetime.now()
+        get_next.return_value = {'__REALTIME_TIMESTAMP': now - OLDEST_LOG_RETENTION - timedelta(days=1)}
+        with patch('datetime.datetime', autospec=True) as dt:
+            dt.now.return_value = now
+            self.client(cursor=sentinel.cursor)
+
+        seek_cursor.assert_called_once_with(sentinel.cursor)
+        # skips the old logs
+        seek_realtime.assert_called_once_with(now - OLDEST_LOG_RETENTION)
+
     @patch.object(READER, 'seek_realtime', autospec=True)
     def test_with_no_cursor(self, seek_realtime):
         ''' test when no cursor '''
@@ -38,6 +71,26 @@ class JournaldClientTest(TestCase):
         # seeks to start of this boot
         seek_realtime.assert_called_once_with(now - OLDEST_LOG_RETENTION)
 
+    @patch.multiple(READER, add_match=DEFAULT, seek_realtime=DEFAULT, spec_set=True)
+    def test_matches(self, add_match, seek_realtime):
+        ''' test the journal matches are added to the reader '''
+
+        parent = Mock()
+        parent.attach_mock(add_match, 'add_match')
+        parent.attach_mock(seek_realtime, 'seek_realtime')
+        self.client(matches=['_SYSTEMD_UNIT=x', 'PRIORITY=3'])
+        # before seeking
+        self.assertEqual(parent.mock_calls[0], call.add_match('_SYSTEMD_UNIT=x', 'PRIORITY=3'))
+        seek_realtime.assert_called_once()
+
+    @patch.object(READER, 'add_match', spec_set=True)
+    @patch.object(READER, 'seek_realtime', autospec=True)
+    def test_no_matches(self, seek_realtime, add_match):
+        ''' test no matches are added by default '''
+
+        self.client()
+        add_match.assert_not_called()
+
     def test_messages(self):
         ''' passes logs from reader '''
 
@@ -50,10 +103,10 @@ class JournaldClientTest(TestCase):
                 parent.attach_mock(get_next, 'get_next')
                 parent.attach_mock(wait, 'wait')
 
-                self.assertListEqual(list(self.client()), logs)
+                self.assertEqual(tuple(self.client()), tuple(logs))
                 parent.assert_has_calls(
                     [call.get_next()] * 4 +
-                    [call.wait()] +
+                    [call.wait(CURSOR_SAVE_INTERVAL)] +
                     [call.get_next()] * 4 +
-                    [call.wait()]
+                    [call.wait(CURSOR_SAVE_INTERVAL)]
                 )
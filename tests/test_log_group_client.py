@@ -1,6 +1,5 @@
 from unittest import TestCase
 from unittest.mock import patch, sentinel, call, create_autospec
-import os
 from datetime import datetime
 from moto import mock_cloudwatch
 from botocore.exceptions import ClientError
@@ -10,25 +9,54 @@ from main import CloudWatchClient, LogGroupClient
 def client_error(code, msg='', op=''):
     return ClientError({'Error': {'Code': code, 'Message': msg}}, op)
 
-@mock_cloudwatch
 class LogGroupClientTest(TestCase):
     GROUP = 'log group'
     STREAM = 'log stream'
-    REGION = 'us-east-1'
-    PUT_LOG_EVENTS_RESULT = {'nextSequenceToken': sentinel.next_token}
+    PUT_LOG_EVENTS_RESULT = {}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # start the aws mocks once for the whole class rather than around every test
+        cls.MOCK_AWS = mock_cloudwatch()
+        cls.MOCK_AWS.start()
+        # retries never really sleep, whichever test hits them
+        cls.SLEEP_PATCH = patch('time.sleep')
+        cls.SLEEP = cls.SLEEP_PATCH.start()
+        # autospeccing the boto3 client is slow, only do it once
+        cls.CWL = create_autospec(CloudWatchClient('', '', '').client)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.SLEEP_PATCH.stop()
+        cls.MOCK_AWS.stop()
+        super().tearDownClass()
 
     def setUp(self):
         super().setUp()
-        os.environ['AWS_DEFAULT_REGION'] = self.REGION
-        self.parent = CloudWatchClient('', '', '')
-        self.cwl = self.parent.client = create_autospec(self.parent.client)
+        self.cwl = self.CWL
+        self.cwl.reset_mock()
+        self.SLEEP.reset_mock()
+        with patch('boto3.client', return_value=self.cwl):
+            self.parent = CloudWatchClient('', '', '')
         self.client = LogGroupClient(self.GROUP, self.parent)
         self.cwl.reset_mock()
 
     def test_init(self):
-        client = LogGroupClient(self.GROUP, self.parent)
-        self.assertEqual(client.log_group, self.GROUP)
-        self.cwl.create_log_group.assert_called_once_with(logGroupName=self.GROUP)
+        client = LogGroupClient('other group', self.parent)
+        self.assertEqual(client.log_group, 'other group')
+        # nothing is described up front
+        self.assertEqual(self.cwl.mock_calls, [call.create_log_group(logGroupName='other group')])
+        # the group is remembered
+        self.assertIs(self.parent.known['other group'], client.streams)
+
+    def test_init_known(self):
+        ''' it does not create groups that are known to exist '''
+
+        self.parent.known['other group'] = {self.STREAM}
+        client = LogGroupClient('other group', self.parent)
+        self.assertEqual(self.cwl.mock_calls, [])
+        self.assertEqual(client.streams, {self.STREAM})
 
     def test_create_log_group(self):
         ''' it creates log groups '''
@@ -68,46 +96,31 @@ class LogGroupClientTest(TestCase):
             with self.assertRaises(ClientError):
                 self.client.create_log_stream(self.STREAM)
 
-    def test_get_new_seq_token_empty(self):
-        ''' no log streams found, it should create the log stream '''
-
-        value = dict(logStreams=[])
-        self.cwl.describe_log_streams.return_value = value
-        self.client.get_new_seq_token(self.STREAM)
-        self.assertEqual(self.cwl.mock_calls, [
-            call.describe_log_streams(limit=1, logGroupName=self.GROUP, logStreamNamePrefix=self.STREAM),
-            call.create_log_stream(logGroupName=self.GROUP, logStreamName=self.STREAM),
-        ])
-
-    def test_get_new_seq_token_no_match(self):
-        ''' no matching log streams found, it should create the log stream '''
+    def test_ensure_log_stream(self):
+        ''' it creates unknown streams once '''
 
-        value = dict(logStreams=[dict(logStreamName='blargh')])
-        self.cwl.describe_log_streams.return_value = value
-        self.client.get_new_seq_token(self.STREAM)
+        self.client.ensure_log_stream(self.STREAM)
+        self.client.ensure_log_stream(self.STREAM)
         self.assertEqual(self.cwl.mock_calls, [
-            call.describe_log_streams(limit=1, logGroupName=self.GROUP, logStreamNamePrefix=self.STREAM),
             call.create_log_stream(logGroupName=self.GROUP, logStreamName=self.STREAM),
         ])
+        self.assertIn(self.STREAM, self.client.streams)
+        self.assertIn(self.STREAM, self.parent.known[self.GROUP])
 
-    def test_get_new_seq_token(self):
-        ''' return the seq token '''
-
-        value = dict(logStreams=[dict(logStreamName=self.STREAM, uploadSequenceToken=sentinel.token)])
-        self.cwl.describe_log_streams.return_value = value
-        self.assertIs( self.client.get_new_seq_token(self.STREAM), sentinel.token )
-
-    def test_get_seq_token(self):
-        ''' it should get a new seq token '''
+    def test_ensure_log_stream_exists(self):
+        ''' it remembers streams that already exist '''
 
-        with patch.object(self.client, 'get_new_seq_token', return_value=sentinel.token):
-            self.assertIs( self.client.get_seq_token(self.STREAM), sentinel.token )
+        with patch.object(self.cwl, 'create_log_stream', side_effect=client_error('ResourceAlreadyExistsException')):
+            self.client.ensure_log_stream(self.STREAM)
+        self.assertIn(self.STREAM, self.client.streams)
 
-    def test_get_seq_token_cached(self):
-        ''' it should return a cached seq token '''
+    def test_ensure_log_stream_error(self):
+        ''' it does not remember streams that failed to be created '''
 
-        self.client.tokens[self.STREAM] = sentinel.token
-        self.assertIs( self.client.get_seq_token(self.STREAM), sentinel.token )
+        with patch.object(self.cwl, 'create_log_stream', side_effect=client_error('other error')):
+            with self.assertRaises(ClientError):
+                self.client.ensure_log_stream(self.STREAM)
+        self.assertNotIn(self.STREAM, self.client.streams)
 
     def test_log_messages_no_messages(self):
         ''' no messages, it does nothing '''
@@ -115,61 +128,78 @@ class LogGroupClientTest(TestCase):
         # no aws api calls
         self.assertEqual(len(self.cwl.mock_calls), 0)
 
-    def mock_log_messages(self, seq_token=[sentinel.token], side_effect=[PUT_LOG_EVENTS_RESULT]):
-        with patch.object(self.client, 'get_new_seq_token', side_effect=seq_token, autospec=True) as self.get_new_seq_token:
-            with patch.object(self.parent, 'put_log_messages', autospec=True, side_effect=side_effect) as self.put_log_messages:
-                self.client.log_messages(self.STREAM, sentinel.messages)
+    def mock_log_messages(self, side_effect=[PUT_LOG_EVENTS_RESULT]):
+        with patch.object(self.parent, 'put_log_messages', autospec=True, side_effect=side_effect) as self.put_log_messages:
+            self.client.log_messages(self.STREAM, sentinel.events)
 
     def test_log_messages(self):
         ''' log_messages() uploads logs to cloudwatch '''
 
         self.mock_log_messages()
-        self.get_new_seq_token.assert_called_once_with(self.STREAM)
-        self.put_log_messages.assert_called_once_with(self.GROUP, self.STREAM, sentinel.token, sentinel.messages)
-        self.assertIs(self.client.tokens[self.STREAM], sentinel.next_token)
+        self.cwl.create_log_stream.assert_called_once_with(logGroupName=self.GROUP, logStreamName=self.STREAM)
+        self.put_log_messages.assert_called_once_with(self.GROUP, self.STREAM, sentinel.events)
+
+    def test_log_messages_known_stream(self):
+        ''' log_messages() makes no other calls for known streams '''
+
+        self.client.streams.add(self.STREAM)
+        self.mock_log_messages()
+        self.assertEqual(self.cwl.mock_calls, [])
+        self.put_log_messages.assert_called_once_with(self.GROUP, self.STREAM, sentinel.events)
 
-    @patch('time.sleep')
-    def test_log_messages_throttled(self, sleep):
+    @patch('random.random', return_value=0.5)
+    def test_log_messages_throttled(self, random):
         ''' log_messages() retries if throttled '''
 
         error = client_error('ThrottlingException')
         self.mock_log_messages(side_effect=[error, error, self.PUT_LOG_EVENTS_RESULT])
-        self.put_log_messages.assert_has_calls([call(self.GROUP, self.STREAM, sentinel.token, sentinel.messages) for _ in range(3)])
-        self.assertIs(self.client.tokens[self.STREAM], sentinel.next_token)
+        # backs off exponentially
+        self.assertEqual(self.SLEEP.call_args_list, [call(0.05), call(0.1)])
+        self.put_log_messages.assert_has_calls([call(self.GROUP, self.STREAM, sentinel.events) for _ in range(3)])
+
+    def test_backoff(self):
+        ''' backoff() grows exponentially up to the cap, with jitter '''
+
+        for attempt, delay in enumerate([0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 6.4, 12.8, 25.6, 30, 30]):
+            with patch('random.random', return_value=0):
+                self.assertEqual(LogGroupClient.backoff(attempt), 0)
+            with patch('random.random', return_value=0.999):
+                self.assertAlmostEqual(LogGroupClient.backoff(attempt), delay * 0.999)
+
+    def test_backoff_long_throttling(self):
+        ''' backoff() stays at the cap however many attempts there have been '''
+
+        with patch('random.random', return_value=0.5):
+            for attempt in (100, 1100, 10 ** 6):
+                self.assertEqual(LogGroupClient.backoff(attempt), 15)
 
     def test_log_messages_operation_aborted(self):
         ''' log_messages() retries if aborted '''
 
         error = client_error('OperationAbortedException')
         self.mock_log_messages(side_effect=[error, error, self.PUT_LOG_EVENTS_RESULT])
-        self.put_log_messages.assert_has_calls([call(self.GROUP, self.STREAM, sentinel.token, sentinel.messages) for _ in range(3)])
-        self.assertIs(self.client.tokens[self.STREAM], sentinel.next_token)
-
-    def test_log_messages_invalid_token(self):
-        ''' log_messages() retries with new token '''
-
-        token = 'hereisacloudwatchtoken'
-        error = client_error('InvalidSequenceTokenException', msg='The given sequenceToken is invalid. The next expected sequenceToken is: ' + token)
-        self.mock_log_messages(side_effect=[error, self.PUT_LOG_EVENTS_RESULT])
-        self.put_log_messages.assert_has_calls([call(self.GROUP, self.STREAM, token, sentinel.messages) for token in (sentinel.token, token)])
-        self.assertIs(self.client.tokens[self.STREAM], sentinel.next_token)
+        self.put_log_messages.assert_has_calls([call(self.GROUP, self.STREAM, sentinel.events) for _ in range(3)])
+        # retries straight away
+        self.SLEEP.assert_not_called()
 
-    def test_log_messages_invalid_token_null(self):
-        ''' log_messages() retries on invalid token with null '''
+    def test_log_messages_not_found(self):
+        ''' log_messages() creates the group and stream again if they were deleted '''
 
-        error = client_error('InvalidSequenceTokenException', msg='The given sequenceToken is invalid. The next expected sequenceToken is: null')
+        self.client.streams.add(self.STREAM)
+        error = client_error('ResourceNotFoundException')
         self.mock_log_messages(side_effect=[error, self.PUT_LOG_EVENTS_RESULT])
-        self.put_log_messages.assert_has_calls([call(self.GROUP, self.STREAM, token, sentinel.messages) for token in (sentinel.token, None)])
-        self.assertIs(self.client.tokens[self.STREAM], sentinel.next_token)
+        self.assertEqual(self.cwl.mock_calls, [
+            call.create_log_group(logGroupName=self.GROUP),
+            call.create_log_stream(logGroupName=self.GROUP, logStreamName=self.STREAM),
+        ])
+        self.put_log_messages.assert_has_calls([call(self.GROUP, self.STREAM, sentinel.events) for _ in range(2)])
 
-    def test_log_messages_invalid_token_no_token_given(self):
-        ''' log_messages() fetches new token and retries '''
+    def test_log_messages_not_found_again(self):
+        ''' log_messages() only creates the group and stream again once '''
 
-        error = client_error('InvalidSequenceTokenException', msg='blargh')
-        tokens = [sentinel.token1, sentinel.token2]
-        self.mock_log_messages(seq_token=tokens, side_effect=[error, self.PUT_LOG_EVENTS_RESULT])
-        self.put_log_messages.assert_has_calls([call(self.GROUP, self.STREAM, token, sentinel.messages) for token in tokens])
-        self.assertIs(self.client.tokens[self.STREAM], sentinel.next_token)
+        error = client_error('ResourceNotFoundException')
+        with self.assertRaises(ClientError):
+            self.mock_log_messages(side_effect=[error, error])
 
     def test_log_messages_error(self):
         ''' log_messages() propagates other errors '''